@@ -2,33 +2,56 @@
 import sys
 import os
 from subprocess import Popen, PIPE
-from time import sleep
+from time import sleep, time
 from collections import Iterable
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import scm_aimd
+import scm_config
+import scm_history
 
 # Bin Paths
 ssh_bin = "/usr/bin/ssh"
 git_bin = "/usr/bin/git"
 
 # Global Vars
-server_name = "server.domain.tld"
-user_name = "username"
-pass_word = r"password"
-ssh_user_name = "ssh_username"
+server_name = scm_config.server_name
+user_name = scm_config.user_name
+pass_word = scm_config.pass_word
+ssh_user_name = scm_config.ssh_user_name
 local_repo_directory = "/repositories/git/"
+history_db = scm_history.history_db
+min_transfers = scm_aimd.min_transfers
+max_transfers = scm_aimd.max_transfers
 sleep_time_seconds = 0.1
 __verbose = False
 
 
 # Functions
 def parse_args():
+    global __verbose
+    global history_db
+    global min_transfers
+    global max_transfers
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='Display more verbose output')
-    parser.set_defaults(verbose=False)
+    parser.add_argument('--history-db', dest='history_db', type=str, help='Path to the run history database')
+    parser.add_argument('--no-history', dest='history_db', action='store_const', const=None,
+                        help="Don't record the run history")
+    parser.add_argument('--min-transfers', dest='min_transfers', type=int,
+                        help='Lowest number of fetches to run against the server at once')
+    parser.add_argument('--max-transfers', dest='max_transfers', type=int,
+                        help='Highest number of fetches to run against the server at once')
+    parser.set_defaults(verbose=False, history_db=history_db, min_transfers=min_transfers,
+                        max_transfers=max_transfers)
     args = parser.parse_args()
     # Set verbose flag
-    global __verbose
     __verbose = args.verbose
+    # Set history database
+    history_db = args.history_db
+    # Set concurrency bounds
+    min_transfers = args.min_transfers
+    max_transfers = args.max_transfers
 
 
 def check_paths():
@@ -108,6 +131,26 @@ def do_git_fetch(path):
     return True
 
 
+def get_repo_size(path):
+    # Size of the object store in bytes, or None if it can't be determined.
+    # git count-objects only prints a few lines, so communicate() can't fill up the pipe.
+    p = Popen([git_bin,
+               '-C',
+               '%s' % path,
+               'count-objects',
+               '-v'], stdout=PIPE, stderr=PIPE)
+    stdout, stderr = p.communicate()
+    if not p.returncode == 0:
+        return None
+    # Output is 'key: value' pairs, sizes are in KiB
+    output = stdout.decode().split()
+    counts = dict(zip(output[0::2], output[1::2]))
+    try:
+        return (int(counts['size:']) + int(counts['size-pack:'])) * 1024
+    except (KeyError, ValueError):
+        return None
+
+
 def do_git_clone(url, path):
     p = Popen([git_bin,
                'clone',
@@ -133,6 +176,62 @@ def do_git_clone(url, path):
     return True
 
 
+def transfer_project(n, baselines):
+    n_path = local_repo_directory + n + '/'
+    url = "https://{}/scm/git/{}".format(
+        server_name,
+        n
+    )
+    url_with_creds = "https://{}:{}@{}/scm/git/{}".format(
+        user_name,
+        pass_word,
+        server_name,
+        n
+    )
+    if os.path.isdir(n_path):
+        operation = 'fetch'
+        size_before = get_repo_size(n_path)
+    else:
+        operation = 'clone'
+        size_before = 0
+    ret = False
+    ticket = scm_aimd.acquire()
+    started = time()
+    try:
+        if operation == 'fetch':
+            print("Synchronizing {}...".format(n))
+            print("Remote URL is {}. Starting fetch...".format(url))
+            ret = do_git_fetch(n_path)
+        else:
+            print("First time synchronization on new project {}".format(n), file=sys.stderr)
+            print("Remote URL is {}. Cloning as git mirror...".format(url), file=sys.stderr)
+            ret = do_git_clone(url_with_creds, n_path)
+    except BaseException:
+        scm_aimd.release(ticket, False)
+        raise
+    finished = time()
+    size_after = get_repo_size(n_path) if ret or operation == 'fetch' else None
+    # Only a fetch that had nothing to transfer is comparable with the usual no-op duration
+    baseline = baselines.get((n, operation)) if size_after == size_before else None
+    limit = scm_aimd.release(ticket, ret, finished - started, baseline)
+    scm_history.record('git', n, operation, started, finished, 0 if ret else 1, size_before, size_after)
+    if not ret:
+        print("Project {} failed to sync.".format(n), file=sys.stderr)
+    else:
+        print("Project {} synchronized successfully!".format(n))
+    if __verbose:
+        print("Running up to {} transfers at once.".format(limit))
+
+
+def sync_project(n, baselines):
+    # Label this pool thread's output with the project until it's done, even if the transfer raises
+    scm_aimd.set_project(n)
+    try:
+        transfer_project(n, baselines)
+    finally:
+        scm_aimd.set_project(None)
+
+
 # Main Function
 def main():
     print("Enumerating directories from {}".format(server_name))
@@ -141,36 +240,17 @@ def main():
         sys.exit(-2)
     names = [n for n in names if not n.startswith('git')]
     print("Directory listing from {} succeeded!".format(server_name))
+    if history_db is not None:
+        scm_history.open_history(history_db)
 
-    for n in names:
-        print()
-        n_path = local_repo_directory + n + '/'
-        url = "https://{}/scm/git/{}".format(
-            server_name,
-            n
-        )
-        url_with_creds = "https://{}:{}@{}/scm/git/{}".format(
-            user_name,
-            pass_word,
-            server_name,
-            n
-        )
-        if os.path.isdir(n_path):
-            print("Synchronizing {}...".format(n))
-            print("Remote URL is {}. Starting fetch...".format(url))
-            ret = do_git_fetch(n_path)
-            if not ret:
-                print("Project {} failed to sync.".format(n), file=sys.stderr)
-            else:
-                print("Project {} synchronized successfully!".format(n))
-        else:
-            print("First time synchronization on new project {}".format(n), file=sys.stderr)
-            print("Remote URL is {}. Cloning as git mirror...".format(url), file=sys.stderr)
-            ret = do_git_clone(url_with_creds, n_path)
-            if not ret:
-                print("Project {} failed to sync.".format(n), file=sys.stderr)
-            else:
-                print("Project {} synchronized successfully!".format(n))
+    # Transfers run in parallel, the number running at once adapts to the server's latency and errors
+    scm_aimd.configure(min_transfers, max_transfers)
+    scm_aimd.label_output()
+    baselines = scm_history.typical_durations('git')
+    with ThreadPoolExecutor(max_workers=scm_aimd.max_transfers) as executor:
+        for future in [executor.submit(sync_project, n, baselines) for n in names]:
+            future.result()
+    scm_history.close_history()
 
 
 if __name__ == '__main__':
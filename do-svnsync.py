@@ -2,38 +2,59 @@
 import sys
 import os
 from subprocess import Popen, PIPE
-from time import sleep
+from time import sleep, time
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import scm_aimd
+import scm_config
+import scm_history
 
 # Bin Paths
 ssh_bin = "/usr/bin/ssh"
-svnsync_bin = "/usr/local/bin/svnsync"
+svnsync_bin = scm_config.svnsync_bin
 svnadmin_bin = "/usr/local/bin/svnadmin"
 svnlook_bin = "/usr/local/bin/svnlook"
 
-# SVN HTTP client (this MUST be set to 'serf' if using svn 1.8 or later)
-# However, the 'svnsync sync' command seems to have issues communicating with SCM Manager
-# using the 'serf' client.
-svn_http_client = 'neon'
+# SVN HTTP client (see scm_config.py)
+svn_http_client = scm_config.svn_http_client
 
 # Global Vars
-server_name = "server.domain.tld"
-user_name = "username"
-pass_word = r"password"
-ssh_user_name = "ssh_username"
+server_name = scm_config.server_name
+user_name = scm_config.user_name
+pass_word = scm_config.pass_word
+ssh_user_name = scm_config.ssh_user_name
 local_repo_directory = "/repositories/svn/"
+history_db = scm_history.history_db
+min_transfers = scm_aimd.min_transfers
+max_transfers = scm_aimd.max_transfers
 __verbose = False
 
 
 # Functions
 def parse_args():
+    global __verbose
+    global history_db
+    global min_transfers
+    global max_transfers
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='Display more verbose output')
-    parser.set_defaults(verbose=False)
+    parser.add_argument('--history-db', dest='history_db', type=str, help='Path to the run history database')
+    parser.add_argument('--no-history', dest='history_db', action='store_const', const=None,
+                        help="Don't record the run history")
+    parser.add_argument('--min-transfers', dest='min_transfers', type=int,
+                        help='Lowest number of syncs to run against the server at once')
+    parser.add_argument('--max-transfers', dest='max_transfers', type=int,
+                        help='Highest number of syncs to run against the server at once')
+    parser.set_defaults(verbose=False, history_db=history_db, min_transfers=min_transfers,
+                        max_transfers=max_transfers)
     args = parser.parse_args()
     # Set verbose flag
-    global __verbose
     __verbose = args.verbose
+    # Set history database
+    history_db = args.history_db
+    # Set concurrency bounds
+    min_transfers = args.min_transfers
+    max_transfers = args.max_transfers
 
 
 def check_paths():
@@ -91,6 +112,21 @@ def get_remote_dir_names():
     return output
 
 
+def get_youngest_revision(path):
+    # Youngest revision of the mirror, or None if it can't be determined.
+    # svnlook youngest only prints a single number, so communicate() can't fill up the pipe.
+    p = Popen([svnlook_bin,
+               'youngest',
+               path], stdout=PIPE, stderr=PIPE)
+    stdout, stderr = p.communicate()
+    if not p.returncode == 0:
+        return None
+    try:
+        return int(stdout.decode().strip())
+    except ValueError:
+        return None
+
+
 def sync_repo(path):
     # Sync existing mirror with new changes
     p = Popen([svnsync_bin,
@@ -240,40 +276,76 @@ def create_sync_repo(path, url):
     return True
 
 
-# Main Function
-def main():
-    print("Enumerating directories from {}".format(server_name))
-    names = get_remote_dir_names()
-    if names is None:
-        sys.exit(-2)
-    names = [n for n in names if not n.startswith('svn')]
-    print("Directory listing from {} succeeded!".format(server_name))
-    for n in names:
-        print()
-        n_path = local_repo_directory + n + '/'
-        url = "https://{}/scm/svn/{}".format(
-            server_name,
-            n
-        )
-        if os.path.isdir(n_path):
+def transfer_project(n, baselines):
+    n_path = local_repo_directory + n + '/'
+    url = "https://{}/scm/svn/{}".format(
+        server_name,
+        n
+    )
+    if os.path.isdir(n_path):
+        operation = 'sync'
+        revision_before = get_youngest_revision(n_path)
+    else:
+        operation = 'create'
+        revision_before = 0
+    ret = False
+    ticket = scm_aimd.acquire()
+    started = time()
+    try:
+        if operation == 'sync':
             print("Synchronizing {}...".format(n))
             print("Remote URL is {}. Starting svnsync sync...".format(url))
             ret = sync_repo(n_path)
-            if not ret:
-                print("Project {} failed to sync.".format(n))
-                continue
         else:
             print("First time synchronization on new project {}".format(n))
             print(("Remote URL is {}. Initializing mirror repository if necessary"
                    " and performing initial sync...".format(url)))
             ret = create_sync_repo(n_path, url)
-            if not ret:
-                print("Project {} failed to sync.".format(n), file=sys.stderr)
-                continue
-            ret = sync_repo(n_path)
-            if not ret:
-                print("Project {} failed to sync.".format(n), file=sys.stderr)
-                continue
+            if ret:
+                ret = sync_repo(n_path)
+    except BaseException:
+        scm_aimd.release(ticket, False)
+        raise
+    finished = time()
+    revision_after = get_youngest_revision(n_path) if ret or operation == 'sync' else None
+    # Only a sync that had nothing to transfer is comparable with the usual no-op duration
+    baseline = baselines.get((n, operation)) if revision_after == revision_before else None
+    limit = scm_aimd.release(ticket, ret, finished - started, baseline)
+    scm_history.record('svn', n, operation, started, finished, 0 if ret else 1,
+                       revision_before=revision_before, revision_after=revision_after)
+    if not ret:
+        print("Project {} failed to sync.".format(n), file=sys.stderr)
+    if __verbose:
+        print("Running up to {} transfers at once.".format(limit))
+
+
+def sync_project(n, baselines):
+    # Label this pool thread's output with the project until it's done, even if the transfer raises
+    scm_aimd.set_project(n)
+    try:
+        transfer_project(n, baselines)
+    finally:
+        scm_aimd.set_project(None)
+
+
+# Main Function
+def main():
+    print("Enumerating directories from {}".format(server_name))
+    names = get_remote_dir_names()
+    if names is None:
+        sys.exit(-2)
+    names = [n for n in names if not n.startswith('svn')]
+    print("Directory listing from {} succeeded!".format(server_name))
+    if history_db is not None:
+        scm_history.open_history(history_db)
+    # Transfers run in parallel, the number running at once adapts to the server's latency and errors
+    scm_aimd.configure(min_transfers, max_transfers)
+    scm_aimd.label_output()
+    baselines = scm_history.typical_durations('svn')
+    with ThreadPoolExecutor(max_workers=scm_aimd.max_transfers) as executor:
+        for future in [executor.submit(sync_project, n, baselines) for n in names]:
+            future.result()
+    scm_history.close_history()
 
 
 # Entry Point
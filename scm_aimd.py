@@ -0,0 +1,95 @@
+import sys
+import threading
+
+# Global Vars
+min_transfers = 1
+max_transfers = 8
+# A transfer taking longer than this many times its usual duration means the server is slowing down
+slowdown_factor = 3.0
+# Fraction of the concurrency limit kept after an error or slowdown
+decrease_factor = 0.5
+__limit = 1.0
+__active = 0
+# Bumped on every decrease, transfers started before it can't trigger another one
+__generation = 0
+__condition = threading.Condition()
+# Project handled by the current transfer thread, used to label its output
+current_project = threading.local()
+
+
+# Classes
+class ProjectOutput(object):
+    # Stream that prefixes every line a transfer thread writes with its project name, so the output of parallel
+    # transfers can still be told apart. Partial lines are held per thread until they're complete.
+    def __init__(self, stream):
+        self.stream = stream
+        self.partial = threading.local()
+
+    def write(self, text):
+        project = getattr(current_project, 'name', None)
+        if project is None:
+            return self.stream.write(text)
+        lines = (getattr(self.partial, 'text', '') + text).split('\n')
+        self.partial.text = lines.pop()
+        for line in lines:
+            self.stream.write("[{}] {}\n".format(project, line))
+        return len(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+# Functions
+def label_output():
+    # Prefix the lines printed by transfer threads with their project name
+    if not isinstance(sys.stdout, ProjectOutput):
+        sys.stdout = ProjectOutput(sys.stdout)
+    if not isinstance(sys.stderr, ProjectOutput):
+        sys.stderr = ProjectOutput(sys.stderr)
+
+
+def set_project(name):
+    current_project.name = name
+
+
+def configure(lower, upper):
+    global min_transfers
+    global max_transfers
+    global __limit
+    with __condition:
+        min_transfers = max(1, lower)
+        max_transfers = max(min_transfers, upper)
+        # Start at the lower bound and let healthy transfers raise the limit
+        __limit = float(min_transfers)
+
+
+def acquire():
+    # Block until a transfer slot is free under the current limit. Returns a ticket to hand to release().
+    global __active
+    with __condition:
+        while __active >= int(__limit):
+            __condition.wait()
+        __active += 1
+        return __generation
+
+
+def release(ticket, ok, duration=None, baseline=None):
+    # Return a transfer slot and adjust the limit from its outcome. Errors and transfers slower than
+    # slowdown_factor times their baseline duration halve the limit, anything else raises it by one per
+    # round of transfers. Returns the new limit.
+    global __active
+    global __limit
+    global __generation
+    with __condition:
+        __active -= 1
+        congested = not ok or (baseline is not None and duration is not None and
+                               duration > baseline * slowdown_factor)
+        if congested:
+            # Transfers started before the last decrease were already counted in it
+            if ticket == __generation:
+                __limit = max(float(min_transfers), __limit * decrease_factor)
+                __generation += 1
+        else:
+            __limit = min(float(max_transfers), __limit + 1.0 / int(__limit))
+        __condition.notify_all()
+        return int(__limit)
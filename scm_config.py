@@ -0,0 +1,13 @@
+# SCM-Manager server and accounts shared by the sync and verify scripts
+server_name = "server.domain.tld"
+user_name = "username"
+pass_word = r"password"
+ssh_user_name = "ssh_username"
+
+# svnsync is run by do-svnsync.py and by verify-svn.py when repairing a mirror
+svnsync_bin = "/usr/local/bin/svnsync"
+
+# SVN HTTP client (this MUST be set to 'serf' if using svn 1.8 or later)
+# However, the 'svnsync sync' command seems to have issues communicating with SCM Manager
+# using the 'serf' client.
+svn_http_client = 'neon'
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3 -tt
+import sys
+import os
+import sqlite3
+import atexit
+import threading
+import argparse
+from time import time
+from datetime import datetime
+
+# Global Vars
+history_db = "/repositories/scm-history.db"
+# Number of recorded operations to hold in memory before writing them out in a single transaction
+batch_size = 50
+# Without a recorded clone or sync, a rebuild is assumed to take this many times as long as a verification
+rebuild_verify_factor = 3
+__connection = None
+__pending = []
+__lock = threading.Lock()
+
+__schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    scm TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL NOT NULL,
+    exit_code INTEGER NOT NULL,
+    size_before INTEGER,
+    size_after INTEGER,
+    revision_before INTEGER,
+    revision_after INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_repo_idx ON runs (scm, repo, operation, started);
+CREATE INDEX IF NOT EXISTS runs_started_idx ON runs (started);
+"""
+
+
+# Functions
+def open_history(path):
+    global __connection
+    if __connection is not None:
+        return True
+    try:
+        # Workers of the sync scripts may trigger a flush, so the connection is shared between threads
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(__schema)
+    except sqlite3.Error as err:
+        print("Failed to open history database at {}: {}".format(path, err), file=sys.stderr)
+        return False
+    __connection = connection
+    atexit.register(close_history)
+    return True
+
+
+def record(scm, repo, operation, started, finished, exit_code,
+           size_before=None, size_after=None, revision_before=None, revision_after=None, flush=False):
+    # Recording is a no-op when history is disabled or the database could not be opened. Records the verify
+    # rotation depends on are written right away with flush, so a run killed early doesn't lose them.
+    if __connection is None:
+        return
+    with __lock:
+        __pending.append((scm, repo, operation, started, finished, exit_code,
+                          size_before, size_after, revision_before, revision_after))
+        if len(__pending) < batch_size and not flush:
+            return
+    flush_history()
+
+
+def flush_history():
+    with __lock:
+        if __connection is None or not __pending:
+            return
+        try:
+            with __connection:
+                __connection.executemany(
+                    "INSERT INTO runs (scm, repo, operation, started, finished, exit_code,"
+                    " size_before, size_after, revision_before, revision_after)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", __pending)
+        except sqlite3.Error as err:
+            print("Failed to write {} history records: {}".format(len(__pending), err), file=sys.stderr)
+        del __pending[:]
+
+
+def close_history():
+    global __connection
+    flush_history()
+    with __lock:
+        if __connection is not None:
+            __connection.close()
+            __connection = None
+
+
+def slowest_repos(since, limit, scm=None, operation=None):
+    return __connection.execute(
+        "SELECT scm, repo, operation, COUNT(*), AVG(finished - started), MAX(finished - started)"
+        " FROM runs WHERE started >= ? AND (? IS NULL OR scm = ?) AND (? IS NULL OR operation = ?)"
+        " GROUP BY scm, repo, operation ORDER BY AVG(finished - started) DESC LIMIT ?",
+        (since, scm, scm, operation, operation, limit)).fetchall()
+
+
+def duration_trend(since, scm=None, operation=None, repo=None):
+    # Operations take very different times, so each one gets its own trend
+    return __connection.execute(
+        "SELECT date(started, 'unixepoch', 'localtime') AS day, scm, operation, COUNT(*),"
+        " AVG(finished - started), MAX(finished - started), SUM(exit_code != 0)"
+        " FROM runs WHERE started >= ? AND (? IS NULL OR scm = ?) AND (? IS NULL OR operation = ?)"
+        " AND (? IS NULL OR repo = ?) GROUP BY scm, operation, day ORDER BY scm, operation, day",
+        (since, scm, scm, operation, operation, repo, repo)).fetchall()
+
+
+def failure_streaks(min_streak, scm=None, operation=None):
+    # A streak is every failed run since the most recent successful run of the same operation. A successful repair
+    # ends with a passing verification, so it also ends a verify streak.
+    return __connection.execute(
+        "SELECT scm, repo, operation, COUNT(*) AS streak, MIN(started), MAX(started) FROM runs r"
+        " WHERE exit_code != 0 AND (? IS NULL OR scm = ?) AND (? IS NULL OR operation = ?)"
+        " AND started > COALESCE((SELECT MAX(started) FROM runs s WHERE s.scm = r.scm AND s.repo = r.repo"
+        " AND (s.operation = r.operation OR (r.operation = 'verify' AND s.operation = 'repair'))"
+        " AND s.exit_code = 0), 0)"
+        " GROUP BY scm, repo, operation HAVING streak >= ? ORDER BY streak DESC, scm, repo",
+        (scm, scm, operation, operation, min_streak)).fetchall()
+
+
+def growth_rates(since, limit, scm=None):
+    # Growth per day over the time span each repository's runs actually cover, at least one day. Only fetches
+    # and syncs count, a first clone or create would report the whole repository as growth.
+    return __connection.execute(
+        "SELECT scm, repo,"
+        " SUM(size_after - size_before) * 86400.0 / MAX(MAX(finished) - MIN(started), 86400) AS size_rate,"
+        " SUM(revision_after - revision_before) * 86400.0 / MAX(MAX(finished) - MIN(started), 86400)"
+        " AS revision_rate"
+        " FROM runs WHERE started >= ? AND (? IS NULL OR scm = ?) AND operation IN ('fetch', 'sync')"
+        " AND (size_before IS NOT NULL OR revision_before IS NOT NULL)"
+        " GROUP BY scm, repo"
+        " ORDER BY COALESCE(size_rate, 0) DESC, COALESCE(revision_rate, 0) DESC LIMIT ?",
+        (since, scm, scm, limit)).fetchall()
+
+
+def typical_durations(scm, days=14):
+    # Average duration of the successful runs that transferred nothing, keyed by (repo, operation)
+    if __connection is None:
+        return {}
+    with __lock:
+        rows = __connection.execute(
+            "SELECT repo, operation, AVG(finished - started) FROM runs"
+            " WHERE scm = ? AND exit_code = 0 AND started >= ?"
+            " AND size_after IS size_before AND revision_after IS revision_before GROUP BY repo, operation",
+            (scm, time() - days * 86400)).fetchall()
+    return dict(((repo, operation), duration) for repo, operation, duration in rows)
+
+
+def rebuild_estimate(scm, repo, verify_duration):
+    # How long rebuilding the repository may take: the longest recorded clone, svnsync from scratch, repair, fetch
+    # or sync of it, and at least rebuild_verify_factor times its verification for mirrors that predate the history
+    estimate = verify_duration * rebuild_verify_factor
+    if __connection is None:
+        return estimate
+    with __lock:
+        recorded = __connection.execute(
+            "SELECT MAX(finished - started) FROM runs WHERE scm = ? AND repo = ?"
+            " AND operation IN ('clone', 'create', 'repair', 'fetch', 'sync')", (scm, repo)).fetchone()[0]
+    if recorded is None:
+        return estimate
+    return max(recorded, estimate)
+
+
+def verification_order(scm, repo_names, max_days):
+    # Order repositories for a rotating verification: never verified first, then those not verified for more than
+    # max_days, then those that failed their last verification, then those changed by a sync since it, then least
+    # recently verified. A successful repair counts as a passing verification. Returns (repo, estimated duration,
+    # overdue) tuples. The estimate is the duration of the last verify run whatever its outcome, or the average of
+    # those for repositories never verified.
+    state = {}
+    for repo, verified, duration, exit_code, changed in __connection.execute(
+            "SELECT l.repo, l.verified, (SELECT d.finished - d.started FROM runs d WHERE d.scm = ? AND d.repo = l.repo"
+            " AND d.operation = 'verify' ORDER BY d.finished DESC LIMIT 1), l.exit_code,"
+            " EXISTS(SELECT 1 FROM runs c WHERE c.scm = ? AND c.repo = l.repo"
+            " AND c.operation NOT IN ('verify', 'repair') AND c.started > l.verified"
+            " AND (c.size_after IS NOT c.size_before OR c.revision_after IS NOT c.revision_before))"
+            " FROM (SELECT repo, MAX(finished) AS verified, exit_code FROM runs WHERE scm = ?"
+            " AND (operation = 'verify' OR (operation = 'repair' AND exit_code = 0)) GROUP BY repo) l",
+            (scm, scm, scm)):
+        state[repo] = (verified, duration, exit_code, changed)
+    durations = [duration for verified, duration, exit_code, changed in state.values() if duration is not None]
+    default_estimate = sum(durations) / len(durations) if durations else None
+    overdue_before = time() - max_days * 86400
+    order = []
+    for name in repo_names:
+        if name not in state:
+            order.append((0, 0, name, default_estimate, True))
+            continue
+        verified, duration, exit_code, changed = state[name]
+        if verified < overdue_before:
+            order.append((1, verified, name, duration, True))
+        elif not exit_code == 0:
+            order.append((2, verified, name, duration, False))
+        elif changed:
+            order.append((3, verified, name, duration, False))
+        else:
+            order.append((4, verified, name, duration, False))
+    order.sort()
+    return [(name, duration, overdue) for tier, verified, name, duration, overdue in order]
+
+
+def format_optional(value, fmt):
+    if value is None:
+        return '-'
+    return fmt.format(value)
+
+
+def print_report(args):
+    since = time() - args.days * 86400
+    if args.report == 'slowest':
+        rows = slowest_repos(since, args.limit, args.scm, args.operation)
+        print("{:<4} {:<40} {:<10} {:>6} {:>10} {:>10}".format('SCM', 'Repository', 'Operation', 'Runs',
+                                                               'Avg (s)', 'Max (s)'))
+        for scm, repo, operation, runs, avg, longest in rows:
+            print("{:<4} {:<40} {:<10} {:>6} {:>10.1f} {:>10.1f}".format(scm, repo, operation, runs, avg, longest))
+    elif args.report == 'trend':
+        rows = duration_trend(since, args.scm, args.operation, args.repo)
+        print("{:<4} {:<10} {:<10} {:>6} {:>10} {:>10} {:>8}".format('SCM', 'Operation', 'Day', 'Runs', 'Avg (s)',
+                                                                     'Max (s)', 'Failed'))
+        for day, scm, operation, runs, avg, longest, failed in rows:
+            print("{:<4} {:<10} {:<10} {:>6} {:>10.1f} {:>10.1f} {:>8}".format(scm, operation, day, runs, avg,
+                                                                               longest, failed))
+    elif args.report == 'streaks':
+        rows = failure_streaks(args.min_streak, args.scm, args.operation)
+        print("{:<4} {:<40} {:<10} {:>6}  {}".format('SCM', 'Repository', 'Operation', 'Streak', 'Failing since'))
+        for scm, repo, operation, streak, first, last in rows:
+            print("{:<4} {:<40} {:<10} {:>6}  {}".format(
+                scm, repo, operation, streak, datetime.fromtimestamp(first).strftime('%Y-%m-%d %H:%M')))
+    elif args.report == 'growth':
+        rows = growth_rates(since, args.limit, args.scm)
+        print("{:<4} {:<40} {:>14} {:>14}".format('SCM', 'Repository', 'Bytes/day', 'Revisions/day'))
+        for scm, repo, size_rate, revision_rate in rows:
+            print("{:<4} {:<40} {:>14} {:>14}".format(
+                scm, repo, format_optional(size_rate, '{:.0f}'), format_optional(revision_rate, '{:.1f}')))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Query the run history recorded by the sync and verify scripts.')
+    parser.add_argument('-f', '--history-db', dest='history_db', type=str, default=history_db,
+                        help='Path to the history database.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    report = subparsers.add_parser('report', help='Print a report from the recorded history.')
+    report.add_argument('report', choices=['slowest', 'trend', 'streaks', 'growth'],
+                        help='slowest repositories, daily duration trend, current failure streaks '
+                             'or repository growth rates.')
+    report.add_argument('-s', '--scm', dest='scm', choices=['git', 'svn'], default=None,
+                        help='Only include repositories of this type.')
+    report.add_argument('-o', '--operation', dest='operation', type=str, default=None,
+                        help='Only include this operation (fetch, clone, sync, create, verify or repair).')
+    report.add_argument('-r', '--repo', dest='repo', type=str, default=None,
+                        help='Only include this repository (trend report only).')
+    report.add_argument('-n', '--limit', dest='limit', type=int, default=20,
+                        help='Maximum number of repositories to list.')
+    report.add_argument('--days', dest='days', type=int, default=30,
+                        help='Number of days of history to include.')
+    report.add_argument('--min-streak', dest='min_streak', type=int, default=3,
+                        help='Minimum number of consecutive failures to report (streaks report only).')
+    return parser.parse_args()
+
+
+# Main Function
+def __main():
+    args = parse_args()
+    if not os.path.isfile(args.history_db):
+        print("History database not found at {}".format(args.history_db), file=sys.stderr)
+        return -1
+    if not open_history(args.history_db):
+        return -2
+    print_report(args)
+    return 0
+
+
+# Entry Point
+if __name__ == '__main__':
+    sys.exit(__main())
@@ -0,0 +1,57 @@
+import os
+import stat
+import ctypes
+import ctypes.util
+import tempfile
+
+# renameat2() arguments to exchange two paths in one step (Linux 3.15 and later)
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+
+# Functions
+def make_repair_directory(repo_path):
+    # Empty directory next to the mirror to rebuild it in. It has to be on the same filesystem to be swapped in,
+    # and its name starts with a dot so the verify scripts skip it.
+    parent, name = os.path.split(os.path.normpath(repo_path))
+    return tempfile.mkdtemp(prefix='.{}.repair-'.format(name), dir=parent)
+
+
+def copy_permissions(live_path, repair_path):
+    # mkdtemp() creates the directory readable by its owner only. Give the rebuilt mirror the live one's mode,
+    # and its owner if the repair ran as someone else, so whoever reads the mirror still can.
+    live_stat = os.stat(live_path)
+    os.chmod(repair_path, stat.S_IMODE(live_stat.st_mode))
+    repair_stat = os.stat(repair_path)
+    if (repair_stat.st_uid, repair_stat.st_gid) == (live_stat.st_uid, live_stat.st_gid):
+        return
+    for dir_path, dir_names, file_names in os.walk(repair_path):
+        os.chown(dir_path, live_stat.st_uid, live_stat.st_gid)
+        for name in file_names:
+            os.lchown(os.path.join(dir_path, name), live_stat.st_uid, live_stat.st_gid)
+
+
+def swap_directories(live_path, repair_path):
+    # Exchange the live mirror with the rebuilt one, leaving the old mirror at repair_path. renameat2() swaps
+    # both paths atomically so readers never find the mirror missing. Where it isn't available, fall back to
+    # renames, which leave the live path missing for a moment. Raises OSError if the rebuilt mirror can't be given
+    # the live one's permissions or can't be moved into place.
+    live_path = os.path.normpath(live_path)
+    repair_path = os.path.normpath(repair_path)
+    copy_permissions(live_path, repair_path)
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if libc.renameat2(AT_FDCWD, os.fsencode(live_path), AT_FDCWD, os.fsencode(repair_path),
+                          RENAME_EXCHANGE) == 0:
+            return
+    except (OSError, AttributeError):
+        pass
+    old_path = repair_path + '.old'
+    os.rename(live_path, old_path)
+    try:
+        os.rename(repair_path, live_path)
+    except OSError:
+        # Put the old mirror back rather than leave the live path missing
+        os.rename(old_path, live_path)
+        raise
+    os.rename(old_path, repair_path)
@@ -1,16 +1,26 @@
 import sys
 import os
 from subprocess import Popen, PIPE
-from time import sleep
+from time import sleep, time
+import shutil
+import tempfile
 import argparse
+import scm_history
+import scm_repair
 
 # Bin paths
 git_bin = '/usr/bin/git'
 
 # Global vars
 __verbose = False
+__history_db = scm_history.history_db
 __repo_dir = '/repositories/git'
+__time_budget = None
+__max_days = 7
 __should_gc = False
+__repair = False
+# Above this many missing objects, refetch everything instead of naming each one
+max_missing_objects = 1000
 
 
 # Functions
@@ -59,11 +69,104 @@ def verify_repository(repo_path, should_gc=False):
     return True
 
 
+def get_missing_objects(repo_path):
+    # Ids of the objects git fsck reports as missing. Its output is spooled to a temporary file, it can be too
+    # long to read back through a pipe.
+    nullpipe = open(os.devnull, "w")
+    output = tempfile.TemporaryFile()
+    p = Popen([git_bin,
+               '-C',
+               repo_path,
+               'fsck'], stdout=output, stderr=nullpipe)
+    p.wait()
+    missing = []
+    output.seek(0)
+    for line in output:
+        words = line.decode(errors='replace').split()
+        if len(words) == 3 and words[0] == 'missing':
+            missing.append(words[2])
+    output.close()
+    return missing
+
+
+def run_git_fetch(repo_path, args):
+    nullpipe = open(os.devnull, "w")
+    p = Popen([git_bin,
+               '-C',
+               repo_path,
+               'fetch'] + args, stdout=nullpipe, stderr=nullpipe)
+    p.wait()
+    if not p.returncode == 0:
+        print("Git fetch failed with return code {}.".format(p.returncode), file=sys.stderr)
+    return p.returncode == 0
+
+
+def repair_repository(repo_path, rebuild_deadline=None):
+    # Repair the mirror, only starting a rebuild before rebuild_deadline if one is given
+    nullpipe = open(os.devnull, "w")
+
+    # A plain fetch tells the server the mirror has everything reachable from its refs, so it never sends missing
+    # objects again. 'git fetch --refetch' (git 2.36 and later) skips that negotiation. Fetch only the objects
+    # fsck reports as missing in place. Refetching everything in place would keep any corrupt pack around, so
+    # anything else means a rebuild.
+    missing = get_missing_objects(repo_path)
+    if 0 < len(missing) <= max_missing_objects:
+        print("Attempting to repair the mirror in place by fetching {} missing objects...".format(len(missing)),
+              file=sys.stdout)
+        if run_git_fetch(repo_path, ['--refetch', 'origin'] + missing) and verify_repository(repo_path):
+            return True
+    if rebuild_deadline is not None and time() > rebuild_deadline:
+        print("Not enough time left in the budget to rebuild {}, run with --repair and without --time-budget to "
+              "rebuild it now.".format(repo_path), file=sys.stderr)
+        return False
+
+    # Rebuild the mirror next to the live one and only swap it in once it verifies
+    p = Popen([git_bin,
+               '-C',
+               repo_path,
+               'config',
+               '--get',
+               'remote.origin.url'], stdout=PIPE, stderr=nullpipe)
+    stdout, stderr = p.communicate()
+    if not p.returncode == 0:
+        print("Can't read the remote URL of {}. Delete the mirror to have the next sync clone it again.".format(
+            repo_path), file=sys.stderr)
+        return False
+    repair_path = scm_repair.make_repair_directory(repo_path)
+    print("Rebuilding the mirror in {}...".format(repair_path), file=sys.stdout)
+    p = Popen([git_bin,
+               'clone',
+               '--mirror',
+               stdout.decode().strip(),
+               repair_path], stdout=nullpipe, stderr=nullpipe)
+    p.wait()
+    if not p.returncode == 0:
+        print("Git clone failed with return code {}.".format(p.returncode), file=sys.stderr)
+        shutil.rmtree(repair_path, ignore_errors=True)
+        return False
+    if not verify_repository(repair_path):
+        shutil.rmtree(repair_path, ignore_errors=True)
+        return False
+    try:
+        scm_repair.swap_directories(repo_path, repair_path)
+    except OSError as err:
+        print("Failed to swap the rebuilt mirror in: {}".format(err), file=sys.stderr)
+        shutil.rmtree(repair_path, ignore_errors=True)
+        return False
+    # The old mirror is now at the repair path
+    shutil.rmtree(repair_path, ignore_errors=True)
+    return True
+
+
 def parse_args():
     global __verbose
     global __repo_dir
+    global __history_db
+    global __time_budget
+    global __max_days
     global git_bin
     global __should_gc
+    global __repair
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False,
@@ -74,15 +177,34 @@ def parse_args():
                         help='Path to the git binary.')
     parser.add_argument('-gc', '--garbage-collect', dest='gc', action='store_true', default=False,
                         help='If set, "git gc" will be run prior to any integrity checks.')
+    parser.add_argument('-r', '--repair', dest='repair', action='store_true', default=False,
+                        help='If set, mirrors failing verification are repaired by fetching into them, or by '
+                             'cloning them again and swapping the clone in.')
+    parser.add_argument('-t', '--time-budget', dest='time_budget', type=float, default=None,
+                        help='Only verify as many repositories as fit in this many minutes, least recently verified '
+                             'first. Requires the run history.')
+    parser.add_argument('--max-days', dest='max_days', type=int, default=__max_days,
+                        help='With --time-budget, repositories not verified for this many days are verified first.')
+    parser.add_argument('--history-db', dest='history_db', type=str, default=__history_db,
+                        help='Path to the run history database.')
+    parser.add_argument('--no-history', dest='history_db', action='store_const', const=None,
+                        help="Don't record the run history.")
     args = parser.parse_args()
     # Set verbose flag
     __verbose = args.verbose
     # Set repo dir
     __repo_dir = args.directory
+    # Set history database
+    __history_db = args.history_db
+    # Set rotation options
+    __time_budget = args.time_budget
+    __max_days = args.max_days
     # Set git bin
     git_bin = args.git_bin
     # Set GC flag
     __should_gc = args.gc
+    # Set repair flag
+    __repair = args.repair
 
 
 def process_output(file):
@@ -98,7 +220,8 @@ def append_to_list(original_list, list_to_append):
 
 
 def get_repository_list(dir_path):
-    return os.listdir(dir_path)
+    # Skip hidden directories, such as mirrors being rebuilt by a repair
+    return [name for name in os.listdir(dir_path) if not name.startswith('.')]
 
 
 def check_paths():
@@ -125,15 +248,63 @@ def __main():
             "The specified repository directory '{}' is not a directory. Please check your path and try again.".format(
                 __repo_dir), file=sys.stderr)
         return -3
+    history_open = __history_db is not None and scm_history.open_history(__history_db)
+    deadline = None
+    if __time_budget is None:
+        rotation = [(repo_name, None, False) for repo_name in repo_list]
+    elif not history_open:
+        print("A time budget requires the run history to track which repositories were verified.", file=sys.stderr)
+        return -4
+    else:
+        rotation = scm_history.verification_order('git', repo_list, __max_days)
+        deadline = time() + __time_budget * 60
+        print("Verifying repositories for up to {} minutes, least recently verified first...".format(__time_budget))
     print("Beginning repository verification process...")
-    for repo_name in repo_list:
+    verified = 0
+    skipped_overdue = []
+    for repo_name, estimate, overdue in rotation:
+        if deadline is not None:
+            remaining = deadline - time()
+            # Skip repositories expected to take longer than the budget left, a smaller one may fit
+            if remaining <= 0 or (estimate is not None and estimate > remaining):
+                if overdue:
+                    skipped_overdue.append(repo_name)
+                continue
         print()
         print("Verifying {}...".format(repo_name))
         full_path = os.path.join(__repo_dir, repo_name)
-        if verify_repository(full_path, __should_gc):
+        started = time()
+        ret = verify_repository(full_path, __should_gc)
+        finished = time()
+        scm_history.record('git', repo_name, 'verify', started, finished, 0 if ret else 1,
+                           flush=True)
+        verified += 1
+        if ret:
             print("{} verified successfully!".format(repo_name), file=sys.stdout)
         else:
             print("{} failed to verify.".format(repo_name), file=sys.stderr)
+            if not __repair:
+                continue
+            # A rebuild transfers the whole repository again, only start one if it fits the budget
+            rebuild_deadline = None
+            if deadline is not None:
+                rebuild_deadline = deadline - scm_history.rebuild_estimate('git', repo_name, finished - started)
+            started = time()
+            ret = repair_repository(full_path, rebuild_deadline)
+            finished = time()
+            scm_history.record('git', repo_name, 'repair', started, finished, 0 if ret else 1,
+                               flush=True)
+            if ret:
+                print("{} repaired successfully!".format(repo_name), file=sys.stdout)
+            else:
+                print("{} could not be repaired.".format(repo_name), file=sys.stderr)
+    if deadline is not None:
+        print()
+        print("Verified {} of {} repositories within the time budget.".format(verified, len(rotation)))
+        if skipped_overdue:
+            print("{} repositories were not verified for over {} days and did not fit in the time budget: {}".format(
+                len(skipped_overdue), __max_days, ' '.join(skipped_overdue)), file=sys.stderr)
+    scm_history.close_history()
     return 0
 
 
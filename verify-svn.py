@@ -1,38 +1,197 @@
 import sys
 import os
 from subprocess import Popen, PIPE
-from time import sleep
+from time import sleep, time
+import shutil
+import tempfile
 import argparse
+import scm_config
+import scm_history
+import scm_repair
 
 # Bin paths
 svnadmin_bin = '/usr/bin/svnadmin'
+svnsync_bin = scm_config.svnsync_bin
 
 # Global vars
 __verbose = False
+__history_db = scm_history.history_db
 __repo_dir = '/repositories/svn'
+__time_budget = None
+__max_days = 7
+__repair = False
 
 
 # Functions
 def verify_repository(repo_path):
+    # Returns whether the repository verified, and the last revision that verified (None if not even revision 0 did)
     global __verbose
 
     # Since Python reads the buffer slower than it fills up, we deadlock and the program won't finish in a timely manner
-    # Throw the output away because of this.
-    nullpipe = open(os.devnull, "w")
+    # Spool the output to a temporary file because of this, it's only read back for the verified revisions.
+    output = tempfile.TemporaryFile()
     p = Popen([svnadmin_bin,
                'verify',
-               repo_path], stdout=nullpipe, stderr=nullpipe)
+               repo_path], stdout=output, stderr=output)
     p.wait()
+    last_verified = get_last_verified_revision(output)
+    output.close()
     if not p.returncode == 0:
         print("Svnadmin verify failed with return code {}".format(p.returncode), file=sys.stderr)
+        return False, last_verified
+    return True, last_verified
+
+
+def get_last_verified_revision(output):
+    # svnadmin verify reports '* Verified revision N.' for every revision in order
+    last_verified = None
+    output.seek(0)
+    for line in output:
+        words = line.decode(errors='replace').split()
+        if words[:3] == ['*', 'Verified', 'revision']:
+            try:
+                last_verified = int(words[3].rstrip('.'))
+            except (IndexError, ValueError):
+                pass
+    return last_verified
+
+
+def run_quietly(args):
+    # Run a command with its output thrown away, returning its return code
+    nullpipe = open(os.devnull, "w")
+    p = Popen(args, stdout=nullpipe, stderr=nullpipe)
+    p.wait()
+    nullpipe.close()
+    return p.returncode
+
+
+def sync_mirror(repo_path):
+    return run_quietly([svnsync_bin,
+                        'sync',
+                        '--non-interactive',
+                        '--username',
+                        scm_config.user_name,
+                        '--password',
+                        scm_config.pass_word,
+                        '--config-option=servers:global:http-library={}'.format(scm_config.svn_http_client),
+                        'file://{}'.format(os.path.abspath(repo_path))])
+
+
+def rebuild_mirror(repo_path, repair_path, last_verified):
+    # Create the new mirror the way do-svnsync.py does
+    ret = run_quietly([svnadmin_bin,
+                       'create',
+                       repair_path])
+    if not ret == 0:
+        print("Svnadmin create failed with return code {}".format(ret), file=sys.stderr)
+        return False
+    revprop_path = os.path.join(repair_path, 'hooks', 'pre-revprop-change')
+    try:
+        with open(revprop_path, 'w') as out:
+            out.write("#!/bin/sh")
+        os.chmod(revprop_path, 0o755)
+    except (IOError, OSError) as err:
+        print("An error occurred while writing to {} with error code {}: {}".format(
+            revprop_path, err.errno, err.strerror), file=sys.stderr)
+        return False
+
+    # Copy every revision that verified from the live mirror, so only the rest is transferred again. Revision 0
+    # carries the svnsync settings (source URL and UUID) along with it.
+    nullpipe = open(os.devnull, "w")
+    dump = Popen([svnadmin_bin,
+                  'dump',
+                  '--quiet',
+                  '-r',
+                  '0:{}'.format(last_verified),
+                  repo_path], stdout=PIPE, stderr=nullpipe)
+    load = Popen([svnadmin_bin,
+                  'load',
+                  '--quiet',
+                  '--force-uuid',
+                  '--bypass-prop-validation',
+                  repair_path], stdin=dump.stdout, stdout=nullpipe, stderr=nullpipe)
+    # Let svnadmin dump see a broken pipe if svnadmin load exits early
+    dump.stdout.close()
+    load.wait()
+    dump.wait()
+    nullpipe.close()
+    if not dump.returncode == 0 or not load.returncode == 0:
+        print("Copying revisions 0 to {} failed with return codes {} (dump) and {} (load)".format(
+            last_verified, dump.returncode, load.returncode), file=sys.stderr)
+        return False
+
+    # Point svnsync at the last copied revision and clear any sync in progress on the live mirror
+    with tempfile.NamedTemporaryFile('w') as merged:
+        merged.write(str(last_verified))
+        merged.flush()
+        ret = run_quietly([svnadmin_bin,
+                           'setrevprop',
+                           repair_path,
+                           '-r', '0',
+                           'svn:sync-last-merged-rev',
+                           merged.name])
+    if not ret == 0:
+        print("Svnadmin setrevprop failed with return code {}".format(ret), file=sys.stderr)
+        return False
+    for prop in ('svn:sync-currently-copying', 'svn:sync-lock'):
+        # These are usually not set, so don't mind if there's nothing to delete
+        run_quietly([svnadmin_bin,
+                     'delrevprop',
+                     repair_path,
+                     '-r', '0',
+                     prop])
+
+    ret = sync_mirror(repair_path)
+    if not ret == 0:
+        print("Svnsync sync failed with return code {}".format(ret), file=sys.stderr)
+        return False
+    return verify_repository(repair_path)[0]
+
+
+def repair_repository(repo_path, last_verified, rebuild_deadline=None):
+    # Try the cheap fix first: recover the repository and let svnsync finish what it was doing, which fixes
+    # half-copied revisions left behind by an interrupted sync. Its lock is left alone, a sync may be running.
+    # Only start a rebuild before rebuild_deadline if one is given.
+    print("Attempting to repair the mirror in place with 'svnadmin recover' and 'svnsync sync'...")
+    if run_quietly([svnadmin_bin, 'recover', repo_path]) == 0 and sync_mirror(repo_path) == 0:
+        ok, last_verified = verify_repository(repo_path)
+        if ok:
+            return True
+    if last_verified is None:
+        print("Revision 0 of {} doesn't verify, so its svnsync settings are lost. Delete the mirror to have the "
+              "next sync create it again.".format(repo_path), file=sys.stderr)
         return False
+    if rebuild_deadline is not None and time() > rebuild_deadline:
+        print("Not enough time left in the budget to rebuild {}, run with --repair and without --time-budget to "
+              "rebuild it now.".format(repo_path), file=sys.stderr)
+        return False
+
+    # Rebuild the mirror next to the live one from the last good revision and only swap it in once it verifies
+    repair_path = scm_repair.make_repair_directory(repo_path)
+    print("Rebuilding the mirror in {} from revision {}...".format(repair_path, last_verified))
+    if not rebuild_mirror(repo_path, repair_path, last_verified):
+        shutil.rmtree(repair_path, ignore_errors=True)
+        return False
+    try:
+        scm_repair.swap_directories(repo_path, repair_path)
+    except OSError as err:
+        print("Failed to swap the rebuilt mirror in: {}".format(err), file=sys.stderr)
+        shutil.rmtree(repair_path, ignore_errors=True)
+        return False
+    # The old mirror is now at the repair path
+    shutil.rmtree(repair_path, ignore_errors=True)
     return True
 
 
 def parse_args():
     global __verbose
     global __repo_dir
+    global __history_db
+    global __time_budget
+    global __max_days
+    global __repair
     global svnadmin_bin
+    global svnsync_bin
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False,
@@ -40,14 +199,37 @@ def parse_args():
     parser.add_argument('-d', '--directory', dest='directory', type=str, default=__repo_dir,
                         help='Path to the repositories directory.')
     parser.add_argument('-b', '--svnadmin', dest='svnadmin_bin', type=str, default=svnadmin_bin)
+    parser.add_argument('--svnsync', dest='svnsync_bin', type=str, default=svnsync_bin,
+                        help='Path to the svnsync binary, used by --repair.')
+    parser.add_argument('-r', '--repair', dest='repair', action='store_true', default=False,
+                        help='If set, mirrors failing verification are repaired by re-syncing them, or by rebuilding '
+                             'them from their last good revision and swapping the rebuilt mirror in.')
+    parser.add_argument('-t', '--time-budget', dest='time_budget', type=float, default=None,
+                        help='Only verify as many repositories as fit in this many minutes, least recently verified '
+                             'first. Requires the run history.')
+    parser.add_argument('--max-days', dest='max_days', type=int, default=__max_days,
+                        help='With --time-budget, repositories not verified for this many days are verified first.')
+    parser.add_argument('--history-db', dest='history_db', type=str, default=__history_db,
+                        help='Path to the run history database.')
+    parser.add_argument('--no-history', dest='history_db', action='store_const', const=None,
+                        help="Don't record the run history.")
     args = parser.parse_args()
     # Set verbose flag
 
     __verbose = args.verbose
     # Set repo dir
     __repo_dir = args.directory
+    # Set history database
+    __history_db = args.history_db
+    # Set rotation options
+    __time_budget = args.time_budget
+    __max_days = args.max_days
     # Set svnadmin bin
     svnadmin_bin = args.svnadmin_bin
+    # Set svnsync bin
+    svnsync_bin = args.svnsync_bin
+    # Set repair flag
+    __repair = args.repair
 
 
 def process_output(file):
@@ -63,13 +245,16 @@ def append_to_list(original_list, list_to_append):
 
 
 def get_repository_list(dir_path):
-    return os.listdir(dir_path)
+    # Skip hidden directories, such as mirrors being rebuilt by a repair
+    return [name for name in os.listdir(dir_path) if not name.startswith('.')]
 
 
 def check_paths():
     global __repo_dir
     if not os.path.exists(svnadmin_bin):
         return "Can't find svnadmin binary at {}.".format(svnadmin_bin)
+    if __repair and not os.path.exists(svnsync_bin):
+        return "Can't find svnsync binary at {}, which --repair needs.".format(svnsync_bin)
     if not os.path.exists(__repo_dir):
         return "Repository directory path does not exist at {}".format(__repo_dir)
     return None
@@ -90,15 +275,63 @@ def __main():
             "The specified repository directory '{}' is not a directory. Please check your path and try again.".format(
                 __repo_dir), file=sys.stderr)
         return -3
+    history_open = __history_db is not None and scm_history.open_history(__history_db)
+    deadline = None
+    if __time_budget is None:
+        rotation = [(repo_name, None, False) for repo_name in repo_list]
+    elif not history_open:
+        print("A time budget requires the run history to track which repositories were verified.", file=sys.stderr)
+        return -4
+    else:
+        rotation = scm_history.verification_order('svn', repo_list, __max_days)
+        deadline = time() + __time_budget * 60
+        print("Verifying repositories for up to {} minutes, least recently verified first...".format(__time_budget))
     print("Beginning repository verification process...")
-    for repo_name in repo_list:
+    verified = 0
+    skipped_overdue = []
+    for repo_name, estimate, overdue in rotation:
+        if deadline is not None:
+            remaining = deadline - time()
+            # Skip repositories expected to take longer than the budget left, a smaller one may fit
+            if remaining <= 0 or (estimate is not None and estimate > remaining):
+                if overdue:
+                    skipped_overdue.append(repo_name)
+                continue
         print()
         print("Verifying {}".format(repo_name))
         full_path = os.path.join(__repo_dir, repo_name)
-        if verify_repository(full_path):
+        started = time()
+        ret, last_verified = verify_repository(full_path)
+        finished = time()
+        scm_history.record('svn', repo_name, 'verify', started, finished, 0 if ret else 1,
+                           flush=True)
+        verified += 1
+        if ret:
             print("{} verified successfully!".format(repo_name))
         else:
             print("{} failed to verify.".format(repo_name), file=sys.stderr)
+            if not __repair:
+                continue
+            # A rebuild transfers the whole repository again, only start one if it fits the budget
+            rebuild_deadline = None
+            if deadline is not None:
+                rebuild_deadline = deadline - scm_history.rebuild_estimate('svn', repo_name, finished - started)
+            started = time()
+            ret = repair_repository(full_path, last_verified, rebuild_deadline)
+            finished = time()
+            scm_history.record('svn', repo_name, 'repair', started, finished, 0 if ret else 1,
+                               flush=True)
+            if ret:
+                print("{} repaired successfully!".format(repo_name))
+            else:
+                print("{} could not be repaired.".format(repo_name), file=sys.stderr)
+    if deadline is not None:
+        print()
+        print("Verified {} of {} repositories within the time budget.".format(verified, len(rotation)))
+        if skipped_overdue:
+            print("{} repositories were not verified for over {} days and did not fit in the time budget: {}".format(
+                len(skipped_overdue), __max_days, ' '.join(skipped_overdue)), file=sys.stderr)
+    scm_history.close_history()
     return 0
 
 